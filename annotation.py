@@ -6,6 +6,15 @@
 # Windows 10
 """Preprocessing of an annotated text."""
 
+import re
+from itertools import chain
+
+# punctuation that may follow a closing bracket
+_STRIP_CHARS = ",.;:-?!'\")"
+# matches the punctuation tail like str.rstrip(_STRIP_CHARS) would
+_STRIP_TAIL = "(?<![{0}])[{0}]*$".format(re.escape(_STRIP_CHARS))
+_CLOSE_END_RE = re.compile(re.escape("]") + _STRIP_TAIL)
+
 
 class Annotation:
     """Transforms annotated text to Annotation object.
@@ -24,16 +33,28 @@ class Annotation:
         text_split (list): Split text by whitespace character.
         opening_bracket (str): Opening bracket.
         closing_bracket (str): Closing bracket.
-        annotated_indices (set): Contains those indices that are
+        annotated_indices (frozenset): Contains those indices that are
             annotated.
+        annotated_mask (int): Bitmask of annotated_indices, i.e.
+            bit i is set if index i is annotated.
         annotated_indices_groups (list): Contains lists of indices that
             are annotated as one markable.
         not_annotated_indices_groups (list): Consists of lists so that
             each contains one index that is not annotated as a markable.
+        annotated_bounds (tuple): Lists of first indices, last indices
+            and lengths of annotated_indices_groups. Computed on first
+            access.
+        not_annotated_bounds (tuple): Same for
+            not_annotated_indices_groups.
 
     Raises:
         ValueError: If given text is empty.
     """
+    __slots__ = ("text_split", "opening_bracket", "closing_bracket",
+                 "_closing_re", "annotated_indices", "annotated_mask",
+                 "annotated_indices_groups", "not_annotated_indices_groups",
+                 "_annotated_bounds", "_not_annotated_bounds")
+
     def __init__(self, text, opening_bracket='[', closing_bracket=']'):
         if not text:
             raise ValueError("Text cannot be empty.")
@@ -41,27 +62,108 @@ class Annotation:
         self.text_split = text.split()
         self.opening_bracket = opening_bracket
         self.closing_bracket = closing_bracket
-        self.annotated_indices = set()
+        # closing bracket at word end, followed by punctuation only
+        if closing_bracket == "]":
+            self._closing_re = _CLOSE_END_RE
+        else:
+            self._closing_re = re.compile(re.escape(closing_bracket)
+                                          + _STRIP_TAIL)
+        self.annotated_indices = frozenset()
         self.annotated_indices_groups = []
         self.not_annotated_indices_groups = []
+        self.annotated_mask = 0
+        self._annotated_bounds = None
+        self._not_annotated_bounds = None
+
+        if opening_bracket in text or closing_bracket in text:
+            self._extract_indices()
+            self._build_mask()
+        else:  # nothing annotated, no need to scan word by word
+            self.not_annotated_indices_groups = [
+                [num] for num in range(len(self.text_split))]
+
+    @property
+    def annotated_bounds(self):
+        """tuple: Bounds of annotated_indices_groups, see _get_bounds."""
+        if self._annotated_bounds is None:
+            self._annotated_bounds = self._get_bounds(
+                self.annotated_indices_groups)
+        return self._annotated_bounds
 
-        self._extract_indices()
+    @property
+    def not_annotated_bounds(self):
+        """tuple: Bounds of not_annotated_indices_groups."""
+        if self._not_annotated_bounds is None:
+            self._not_annotated_bounds = self._get_bounds(
+                self.not_annotated_indices_groups)
+        return self._not_annotated_bounds
+
+    def compute_bounds(self):
+        """Computes annotated_bounds and not_annotated_bounds now
+        instead of on first access."""
+        self._annotated_bounds = self._get_bounds(
+            self.annotated_indices_groups)
+        self._not_annotated_bounds = self._get_bounds(
+            self.not_annotated_indices_groups)
+
+    @staticmethod
+    def _get_bounds(indices_groups):
+        """Describes each group by its first index, last index and
+        length. Groups are contiguous, so this describes them fully.
+
+        Args:
+            indices_groups (list): Contains lists of indices (int).
+
+        Returns:
+            tuple: 3-tuple consisting of the lists of starts (int),
+                ends (int) and lengths (int).
+        """
+        return ([group[0] for group in indices_groups],
+                [group[-1] for group in indices_groups],
+                [len(group) for group in indices_groups])
 
     def _extract_indices(self):
         """Gets and groups indices of annotated/not annotated words."""
         in_brackets = False
+        unclosed = []  # ranges of markables that are never closed
+        # bound methods, looked up once instead of per word
+        opening_bracket = self.opening_bracket
+        closes = self._closing_re.search
+        append_group = self.annotated_indices_groups.append
+        append_not_annotated = self.not_annotated_indices_groups.append
         for num, word in enumerate(self.text_split):
-            if word.startswith(self.opening_bracket):
+            if word.startswith(opening_bracket):
+                if in_brackets:
+                    unclosed.append(range(start, num))
                 in_brackets = True
-                group = []
-            if in_brackets:  # annotated as markable
-                self.annotated_indices.add(num)
-                group.append(num)
-            if word.rstrip(",.;:-?!'\")").endswith(self.closing_bracket):
-                in_brackets = False
-                self.annotated_indices_groups.append(group)
+                start = num
+            if closes(word):
+                if in_brackets:  # annotated as markable
+                    in_brackets = False
+                    if start == num:  # most markables are one word
+                        group = [num]
+                    else:
+                        group = list(range(start, num + 1))
+                append_group(group)
             elif not in_brackets:  # not annotated as markable
-                self.not_annotated_indices_groups.append([num])
+                append_not_annotated([num])
+        if in_brackets:
+            unclosed.append(range(start, len(self.text_split)))
+        # build the index set in bulk instead of word by word
+        self.annotated_indices = frozenset(chain(
+            chain.from_iterable(self.annotated_indices_groups),
+            chain.from_iterable(unclosed)
+            ))
+
+    def _build_mask(self):
+        """Packs annotated indices into an integer bitmask."""
+        if not self.annotated_indices:
+            return
+        bits = bytearray(b"0") * len(self.text_split)
+        for num in self.annotated_indices:
+            bits[num] = ord("1")
+        # most significant bit first, i.e. highest index first
+        self.annotated_mask = int(bits[::-1], 2)
 
 
 if __name__ == "__main__":
@@ -6,6 +6,8 @@
 # Windows 10
 """Supplementary class for file reading."""
 
+from pathlib import Path
+
 
 class FileToString:
     """Retrieves text from a file.
@@ -27,12 +29,14 @@ class FileToString:
     def _file_to_string(self, file, encoding="utf-8"):
         """Retrieves text from a file."""
         try:
-            with open(file, 'r', encoding=encoding) as read_f:
-                text = read_f.read()
+            # one read and one decode pass instead of chunked text mode
+            text = Path(file).read_bytes().decode(encoding)
         except FileNotFoundError as fnf:
             fnf_msg = file + " does not exist."
             raise FileNotFoundError(fnf_msg).with_traceback(fnf.__traceback__)
         except PermissionError as pe:
             pe_msg = file + " does not lead to a file."
             raise PermissionError(pe_msg).with_traceback(pe.__traceback__)
+        if "\r" in text:  # universal newlines, as in text mode
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
         return text
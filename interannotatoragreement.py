@@ -6,12 +6,24 @@
 # Windows 10
 """Tool to ascertain similarity between two Annotation objects."""
 
+from bisect import bisect_left, bisect_right
+from itertools import combinations
 import os
 
 from annotation import Annotation
 from errors import DifferentTextException
 from filetostring import FileToString
 
+try:
+    _popcount = int.bit_count  # hardware popcount, Python 3.10+
+except AttributeError:
+    def _popcount(mask):
+        """Counts the set bits of a non-negative int."""
+        return bin(mask).count("1")
+
+# annotations shared with the worker processes of pairwise_agreement
+_worker_annotations = None
+
 
 class InterAnnotatorAgreement:
     """Provides metrics to ascertain the InterAnnotatorAgreement (IAA)
@@ -29,6 +41,8 @@ class InterAnnotatorAgreement:
         DifferentTextException: If the two annotated texts are different
             or if annotation guideline violations are encountered.
     """
+    __slots__ = ("ao1", "ao2", "_n_tokens", "_naive_counts")
+
     def __init__(self, annotation_obj1, annotation_obj2):
         if len(annotation_obj1.text_split) != len(annotation_obj2.text_split):
             raise DifferentTextException("Two Annotation objects are"
@@ -37,6 +51,8 @@ class InterAnnotatorAgreement:
 
         self.ao1 = annotation_obj1
         self.ao2 = annotation_obj2
+        self._n_tokens = len(annotation_obj1.text_split)
+        self._naive_counts = None
 
     def naive_accuracy(self):
         """Calculates the proportion of agreeing annotations.
@@ -61,39 +77,42 @@ class InterAnnotatorAgreement:
         Returns:
             float: Mean NGreement. Between 0 and 1.
         """
-        annotated_acc1 = self._ngreement(self.ao1.annotated_indices_groups,
-                                         self.ao2.annotated_indices_groups,
-                                         n=n)
-        not_annotated_acc1 = self._ngreement(self.ao1.not_annotated_indices_groups,
-                                             self.ao2.not_annotated_indices_groups,
-                                             n=n)
-        annotated_acc2 = self._ngreement(self.ao2.annotated_indices_groups,
-                                         self.ao1.annotated_indices_groups,
-                                         n=n)
-        not_annotated_acc2 = self._ngreement(self.ao2.not_annotated_indices_groups,
-                                             self.ao1.not_annotated_indices_groups,
-                                             n=n)
+        ao1 = self.ao1
+        ao2 = self.ao2
         # no markables are annotated at all
-        if (len(self.ao1.annotated_indices_groups) == 0
-            and len(self.ao2.annotated_indices_groups) == 0):
+        if (not ao1.annotated_indices_groups
+                and not ao2.annotated_indices_groups):
             return 1.0
+        annotated_acc1, annotated_acc2 = self._ngreement(
+            ao1.annotated_bounds, ao2.annotated_bounds, n=n)
+        not_annotated_acc1, not_annotated_acc2 = self._ngreement(
+            ao1.not_annotated_bounds, ao2.not_annotated_bounds, n=n)
         return (annotated_acc1 + annotated_acc2
                 + not_annotated_acc1 + not_annotated_acc2)/4
 
-    def levenshtein_incl_normalized(self):
+    def levenshtein_incl_normalized(self, max_distance=None):
         """Normalizes levenshtein distance
         by mean number of identified markables.
 
+        Args:
+            max_distance (int): If given, the computation stops as soon
+                as the distance must exceed it and max_distance + 1 is
+                reported instead. Defaults to None (exact distance).
+
         Returns:
             tuple: 2-tuple consisting of absolute distance (int)
-                and normalization (float).
+                and normalization (float). The normalization is None
+                if the distance exceeds max_distance.
         """
-        distance = self._levenshtein(self.ao1.annotated_indices_groups,
-                                     self.ao2.annotated_indices_groups)
+        distance = self._levenshtein(self.ao1.annotated_bounds,
+                                     self.ao2.annotated_bounds,
+                                     max_distance=max_distance)
         markable_count1 = len(self.ao1.annotated_indices_groups)
         markable_count2 = len(self.ao2.annotated_indices_groups)
         if markable_count1 == 0 and markable_count2 == 0:
             return 0, 0.0
+        if max_distance is not None and distance > max_distance:
+            return distance, None  # only a lower bound is known
         return distance, distance/max(markable_count1, markable_count2)
 
     @staticmethod
@@ -112,12 +131,15 @@ class InterAnnotatorAgreement:
             list: Contains subgrams (= lists of indices (int)).
                 First list is equivalent to full ngram.
         """
-        subgrams = []
+        length = len(ngram)
+        subgrams = [None] * (length*(length + 1)//2)
+        k = 0
         # shortens list from the right hand side
-        for i in range(len(ngram), 0, -1):
+        for i in range(length, 0, -1):
             # shortens list from the left hand side
             for j in range(i):
-                subgrams.append(ngram[j:i])
+                subgrams[k] = ngram[j:i]
+                k += 1
         return subgrams
 
 # private methods #
@@ -126,7 +148,7 @@ class InterAnnotatorAgreement:
         """Counts how many tokens (orthographic words) are annotated/
         not annotated in both annotations equally, regardless of the
         boundaries (= in brackets or not), and how many tokens are
-        annotated differently.
+        annotated differently. Counted once, then cached.
 
         Returns:
             tuple: 3-tuple consisting of:
@@ -136,179 +158,295 @@ class InterAnnotatorAgreement:
                     annotations (int),
                 number of disagreements (int)
         """
-        same_in_bracket = len(
-            self.ao1.annotated_indices.intersection(self.ao2.annotated_indices)
-            )
-        disagree = len(
-            self.ao1.annotated_indices.symmetric_difference(
-                self.ao2.annotated_indices)
-            )
-        same_not_bracket = (len(self.ao1.text_split)
+        if self._naive_counts is not None:
+            return self._naive_counts
+        mask1 = self.ao1.annotated_mask
+        mask2 = self.ao2.annotated_mask
+        if mask1 == mask2:  # e.g. ao1 is ao2
+            same_in_bracket = len(self.ao1.annotated_indices)
+            disagree = 0
+        else:
+            # population count of the intersection
+            same_in_bracket = _popcount(mask1 & mask2)
+            # |A ^ B| = |A| + |B| - 2|A & B|
+            disagree = (len(self.ao1.annotated_indices)
+                        + len(self.ao2.annotated_indices)
+                        - 2*same_in_bracket)
+        same_not_bracket = (self._n_tokens
                             - same_in_bracket
                             - disagree)
-        return same_in_bracket, same_not_bracket, disagree
+        self._naive_counts = same_in_bracket, same_not_bracket, disagree
+        return self._naive_counts
 
-    def _ngreement(self, indice_groups_ref, indice_groups_comp, n=2):
+    def _ngreement(self, bounds1, bounds2, n=2):
         """NGram-based agreement.
         Ascertains how well an annotation is compatible with
         a reference. Takes subset relations into account.
+        Both directions are computed in one go, i.e. once with
+        the first and once with the second groups as reference.
         Example:
-            indice_groups_ref = [[0], [2, 3, 4]]
-            indice_groups_comp = [[0], [3, 4]]
-            max_score = 1**2 + 3**2 = 10
-            score = 1**2 + 2**2 = 5
-            ngreement = 5/10 = 0.5
+            bounds1 = ([0, 2], [0, 4], [1, 3])  # [[0], [2, 3, 4]]
+            bounds2 = ([0, 3], [0, 4], [1, 2])  # [[0], [3, 4]]
+            bounds1 as reference:
+                max_score = 1**2 + 3**2 = 10
+                score = 1**2 + 2**2 = 5
+                ngreement = 5/10 = 0.5
+            bounds2 as reference:
+                max_score = 1**2 + 2**2 = 5
+                score = 1**2 = 1
+                ngreement = 1/5 = 0.2
+            result = (0.5, 0.2)
             Note: We call [3, 4] a subgram of [2, 3, 4].
 
         Args:
-            indice_groups_ref (list): Contains lists of indices (int).
-            indice_groups_comp (list): Contains lists of indices (int).
+            bounds1 (tuple): Starts, ends and lengths (lists of int)
+                of one annotation's groups, see Annotation.
+            bounds2 (tuple): Same for the other annotation's groups.
             n (int): Increasing n increases the reward for correctly
                 annotated long markables. Defaults to 2.
 
         Returns:
-            float: Ratio of achieved score and maximum possible score
-                (see example above). Between 0 and 1.
+            tuple: 2-tuple consisting of the ratios of achieved score
+                and maximum possible score (see example above) with
+                bounds1 as reference (float) and with bounds2 as
+                reference (float). Between 0 and 1.
+        """
+        starts1, ends1, lens1 = bounds1
+        starts2, ends2, lens2 = bounds2
+        # a group weighs the same as reference and as comparison;
+        # each distinct length is raised to the power of n only once
+        powers = {length: length**n for length in set(lens1).union(lens2)}
+        weights1 = [powers[length] for length in lens1]
+        weights2 = [powers[length] for length in lens2]
+        max_score1 = sum(weights1)
+        max_score2 = sum(weights2)
+        score1 = self._ngreement_core(starts1, ends1,
+                                      starts2, ends2, weights2)
+        score2 = self._ngreement_core(starts2, ends2,
+                                      starts1, ends1, weights1)
+        return (score1/max_score1 if max_score1 else 0.0,
+                score2/max_score2 if max_score2 else 0.0)
+
+    @staticmethod
+    def _ngreement_core(ref_starts, ref_ends,
+                        comp_starts, comp_ends, comp_weights):
+        """Scores flat (start, end, weight) descriptions of the groups.
+        Markables are contiguous and sorted, so a comparison group is a
+        subgram exactly if it ends within the last reference group
+        starting at or before it.
+
+        Returns:
+            int: Summed weights of the comparison groups that are
+                subgrams of a reference group.
         """
-        max_score = 0
         score = 0
-        subgrams = []  # to be filled with lists of lists of indices
-        for group in indice_groups_ref:
-            subgrams.append(self.get_subgrams(group))
-            max_score += len(group)**n
-        for group in indice_groups_comp:
-            # first elem is always the largest group with every index
-            for subgram in subgrams:
-                # compare both smallest indices
-                if group[0] < subgram[0][0]:
-                    break  # because indices in subgrams only get higher
-                if group[0] not in subgram[0]:
-                    continue
-                if group in subgram:
-                    score += len(group)**n
-                    break
-        if max_score == 0:
-            return 0.0
-        return score/max_score
-
-    def _levenshtein(self, indices_groups_ref, indices_groups_comp):
+        for k in range(len(comp_starts)):
+            i = bisect_right(ref_starts, comp_starts[k]) - 1
+            if i >= 0 and comp_ends[k] <= ref_ends[i]:  # group is a subgram
+                score += comp_weights[k]
+        return score
+
+    def _levenshtein(self, bounds_ref, bounds_comp, max_distance=None):
         """Computes levenshtein distance, the number of
         editing operations until both lists are equal.
         Example:
-            indices_groups_ref = [[0, 1], [3], [5, 6, 7]]
-            indices_groups_comp = [[0], [5, 6, 7, 8]]
-            distance =
+            bounds_ref = ([0, 3, 5], [1, 3, 7], [2, 1, 3])
+                # [[0, 1], [3], [5, 6, 7]]
+            bounds_comp = ([0, 5], [0, 8], [1, 4])  # [[0], [5, 6, 7, 8]]
+            distance = 3 (delete 1, delete [3], add 8)
             Note: The distance is symmetric. Therefore the result
             is not affected by the choice of the reference annotation.
 
         Args:
-            indices_groups_ref (list): Contains grouped indices
-                (one sublist for each markable).
-            indices_groups_comp (list): Contains grouped indices
-                (one sublist for each markable).
+            bounds_ref (tuple): Starts, ends and lengths (lists of int)
+                of the grouped indices (one group for each markable),
+                see Annotation.
+            bounds_comp (tuple): Same for the other annotation.
+            max_distance (int): Stops early once the distance is known
+                to exceed it. Defaults to None.
 
         Returns:
-            int: Levenshtein distance >= 0.
+            int: Levenshtein distance >= 0, or max_distance + 1 if the
+                distance is greater than max_distance.
         """
-        # base cases
-        if len(indices_groups_ref) == 0 and len(indices_groups_comp) == 0:
-            return 0
-        if len(indices_groups_ref) == 0:
-            return len(indices_groups_comp)  # number of superfluous groups
-        if len(indices_groups_comp) == 0:
-            return len(indices_groups_ref)  # number of missing groups
-
-        # recursive cases
-        if indices_groups_ref[0] == indices_groups_comp[0]:
-            return self._levenshtein(indices_groups_ref[1:],
-                                     indices_groups_comp[1:])
-        else:
-            if self._is_compatible(indices_groups_ref[0],
-                                   indices_groups_comp[0]):
+        starts_ref, ends_ref, _ = bounds_ref
+        starts_comp, ends_comp, _ = bounds_comp
+        len_ref = len(starts_ref)
+        len_comp = len(starts_comp)
+        i_ref = 0
+        i_comp = 0
+        distance = 0
+        # every state (i_ref, i_comp) has exactly one successor,
+        # so walking both lists once suffices
+        while i_ref < len_ref and i_comp < len_comp:
+            # each step consuming k groups of one list costs >= k - 1,
+            # so the difference of the remaining counts is still to pay
+            if (max_distance is not None
+                and distance + abs((len_ref - i_ref) - (len_comp - i_comp))
+                    > max_distance):
+                return max_distance + 1
+            start_ref = starts_ref[i_ref]
+            start_comp = starts_comp[i_comp]
+            # contiguous groups are equal if their bounds are
+            if (start_ref == start_comp
+                and ends_ref[i_ref] == ends_comp[i_comp]):
+                i_ref += 1
+                i_comp += 1
+            elif self._is_compatible(start_ref, ends_ref[i_ref],
+                                     start_comp, ends_comp[i_comp]):
                 # until this index, groups in comp can be transformed to ref
                 compatible_index_boundary_in_ref = (
                     self._find_compatible_index_boundary(
-                        indices_groups_comp[0], indices_groups_ref)
+                        start_comp, ends_comp[i_comp],
+                        starts_ref, ends_ref, i_ref)
                     )
                 compatible_index_boundary_in_comp = (
                     self._find_compatible_index_boundary(
-                        indices_groups_ref[0], indices_groups_comp)
+                        start_ref, ends_ref[i_ref],
+                        starts_comp, ends_comp, i_comp)
                     )
 
-                if (compatible_index_boundary_in_ref
-                    < compatible_index_boundary_in_comp):
-                    return (self._transform_groups_cost(
-                        indices_groups_ref[0],
-                        indices_groups_comp[:compatible_index_boundary_in_comp]
-                        )
-                            + self._levenshtein(
-                                indices_groups_ref[1:],
-                                indices_groups_comp[compatible_index_boundary_in_comp:])
-                                )
+                if (compatible_index_boundary_in_ref - i_ref
+                    < compatible_index_boundary_in_comp - i_comp):
+                    distance += self._transform_groups_cost(
+                        start_ref, ends_ref[i_ref], starts_comp, ends_comp,
+                        i_comp, compatible_index_boundary_in_comp)
+                    i_ref += 1
+                    i_comp = compatible_index_boundary_in_comp
                 else:
-                    return (self._transform_groups_cost(
-                        indices_groups_comp[0],
-                        indices_groups_ref[:compatible_index_boundary_in_ref]
-                        )
-                            + self._levenshtein(
-                                indices_groups_ref[compatible_index_boundary_in_ref:],
-                                indices_groups_comp[1:])
-                                )
-
-            else:  # first groups disagree completely
-                # first ref group is missing
-                if indices_groups_ref[0][0] < indices_groups_comp[0][0]:
-                    return 1 + self._levenshtein(indices_groups_ref[1:],
-                                                 indices_groups_comp)
-                else:  # first comp group is too much
-                    return 1 + self._levenshtein(indices_groups_ref,
-                                                 indices_groups_comp[1:])
+                    distance += self._transform_groups_cost(
+                        start_comp, ends_comp[i_comp], starts_ref, ends_ref,
+                        i_ref, compatible_index_boundary_in_ref)
+                    i_ref = compatible_index_boundary_in_ref
+                    i_comp += 1
+            # first groups disagree completely
+            elif start_ref < start_comp:  # first ref group is missing
+                distance += 1
+                i_ref += 1
+            else:  # first comp group is too much
+                distance += 1
+                i_comp += 1
+        # number of missing or superfluous groups
+        distance += (len_ref - i_ref) + (len_comp - i_comp)
+        if max_distance is not None and distance > max_distance:
+            return max_distance + 1
+        return distance
 
     @staticmethod
-    def _transform_groups_cost(group_ref, indices_groups_comp):
-        """Ascertains number of required editing operations."""
-        set_ref = set(group_ref)
-        set_comp = set()
-        for group in indices_groups_comp:
-            set_comp.update(set(group))
-        add_delete_cost = len(set_ref.symmetric_difference(set_comp))
-        merge_cost = len(indices_groups_comp) - 1
+    def _transform_groups_cost(ref_start, ref_end, comp_starts, comp_ends,
+                               i_start, i_stop):
+        """Ascertains number of required editing operations to transform
+        the comparison groups i_start to i_stop (exclusive) into the
+        reference group, each given by its first and last index.
+        Groups are contiguous runs of indices, so the size of the
+        symmetric difference follows from the interval bounds.
+        """
+        len_comp = 0
+        shared = 0
+        previous_start = None
+        for num in range(i_start, i_stop):
+            comp_start = comp_starts[num]
+            if comp_start == previous_start:  # repeated by a stray bracket
+                continue
+            previous_start = comp_start
+            comp_end = comp_ends[num]
+            len_comp += comp_end - comp_start + 1
+            overlap = min(comp_end, ref_end) - max(comp_start, ref_start) + 1
+            if overlap > 0:
+                shared += overlap
+        add_delete_cost = ref_end - ref_start + 1 + len_comp - 2*shared
+        merge_cost = i_stop - i_start - 1
         return add_delete_cost + merge_cost
 
     @staticmethod
-    def _is_compatible(group_ref, group_comp):
+    def _is_compatible(ref_start, ref_end, comp_start, comp_end):
         """Checks whether the two groups share at least one index.
+        Groups are contiguous, so they do if their intervals overlap.
 
         Args:
-            group_ref (list): Contains indices of one group (= ngram).
-            group_comp (list): Contains indices of one group (= ngram).
+            ref_start (int): First index of one group (= ngram).
+            ref_end (int): Last index of that group.
+            comp_start (int): First index of the other group.
+            comp_end (int): Last index of the other group.
 
         Return:
             bool: True if shared index exists, else False.
         """
-        for index in group_comp:
-            if index in group_ref:
-                return True
-        return False
+        return ref_start <= comp_end and comp_start <= ref_end
 
     @staticmethod
-    def _find_compatible_index_boundary(group_ref, indices_groups_comp):
-        """Finds the maximum number of groups (in indices_groups_comp)
-        whose members (indices) are part of the reference.
-        This number is equivalent to the starting index (if existent)
-        from where on no more matches are possible.
+    def _find_compatible_index_boundary(ref_start, ref_end,
+                                        comp_starts, comp_ends, i_start=0):
+        """Finds the maximum number of groups (beginning at i_start)
+        whose members (indices) are part of the reference group.
+        The returned index (if existent) is the absolute index in
+        comp_starts from where on no more matches are possible.
+        All groups are given by their first and last index; as they
+        are contiguous and sorted, the boundary is found by bisection.
         Example:
-        group_ref = [6, 7, 8]
-        indices_groups_comp = [[6], [7, 8, 9], [10], [11]]
+        ref_start, ref_end = 6, 8  # [6, 7, 8]
+        comp_starts = [6, 7, 10, 11]
+        comp_ends = [6, 9, 10, 11]  # [[6], [7, 8, 9], [10], [11]]
+        i_start = 0
         index_boundary = 2
         """
-        for num1, group in enumerate(indices_groups_comp):
-            for num2, index in enumerate(group):
-                if index not in group_ref:
-                    if num2 == 0:  # whole group already incompatible
-                        return num1
-                    return num1 + 1  # part of the group compatible
-        return num1 + 1
+        if comp_starts[i_start] < ref_start:
+            return i_start  # whole group already incompatible
+        # groups starting within the reference
+        i_stop = bisect_right(comp_starts, ref_end, i_start)
+        if i_stop > i_start and comp_ends[i_stop - 1] > ref_end:
+            # part of the group compatible, stop after its first
+            # occurrence (stray closing brackets may repeat it)
+            return bisect_left(comp_starts, comp_starts[i_stop - 1],
+                               i_start, i_stop) + 1
+        return i_stop
+
+
+def pairwise_agreement(annotation_objs, processes=None):
+    """Compares every pair of annotations of the same text.
+    The pairs are independent, so they are distributed over
+    worker processes.
+
+    Args:
+        annotation_objs (list): Contains Annotation objects.
+        processes (int): Number of worker processes.
+            Defaults to the number of CPUs.
+
+    Returns:
+        dict: Maps index pairs (i, j) with i < j to 3-tuples consisting
+            of naive accuracy (float), mean ngreement (float) and
+            levenshtein distance incl. normalization (tuple).
+
+    Raises:
+        DifferentTextException: If two of the annotated texts are
+            different.
+    """
+    if len(annotation_objs) < 2:
+        return {}  # no pairs, no need for workers
+    # imported here, the other metrics do not need it
+    from multiprocessing import Pool
+    for ao in annotation_objs:
+        # build derived data once, before it is handed to the workers
+        ao.compute_bounds()
+    pairs = list(combinations(range(len(annotation_objs)), 2))
+    with Pool(processes, _init_worker, (annotation_objs,)) as pool:
+        return dict(sorted(pool.imap_unordered(_compare_pair, pairs)))
+
+
+def _init_worker(annotation_objs):
+    """Stores the annotations once per worker process."""
+    global _worker_annotations
+    _worker_annotations = annotation_objs
+
+
+def _compare_pair(pair):
+    """Computes all metrics for one index pair of _worker_annotations."""
+    i, j = pair
+    iaa = InterAnnotatorAgreement(_worker_annotations[i],
+                                  _worker_annotations[j])
+    return pair, (iaa.naive_accuracy(),
+                  iaa.mean_ngreement(),
+                  iaa.levenshtein_incl_normalized())
 
 
 if __name__ == "__main__":
@@ -353,3 +491,7 @@ if __name__ == "__main__":
     print(iaa.mean_ngreement())
     print(">>> print(iaa.levenshtein_incl_normalized())")
     print(iaa.levenshtein_incl_normalized())
+    print("")
+    print("More than two annotations? Compare all pairs at once!")
+    print(">>> print(pairwise_agreement([ao1, ao2, ao1]))")
+    print(pairwise_agreement([ao1, ao2, ao1]))